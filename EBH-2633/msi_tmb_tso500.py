@@ -1,8 +1,19 @@
+import argparse
 import concurrent.futures
+from collections import defaultdict
+import functools
+import io
+import json
+import os
 import dxpy as dx
 import pandas as pd
 import sys
 
+# Rows of the DNA Sample ID to [Gene Amplifications] section (excluding
+# blank lines) of the metrics kept from each CombinedVariantOutput file,
+# the sample ID followed by the MSI and TMB metrics
+MSI_TMB_METRIC_ROWS = [0, 8, 20, 21, 22, 25, 26, 27]
+
 
 def get_002_TSO500_projects_in_period(first_date, last_date):
     """
@@ -34,6 +45,70 @@ def get_002_TSO500_projects_in_period(first_date, last_date):
     return tso_projs_ids
 
 
+@functools.lru_cache(maxsize=None)
+def list_subfolders(project_id, path):
+    """
+    List the subfolders directly within a path of a project, cached so
+    the same folder is never listed twice in a run
+
+    Parameters
+    ----------
+    project_id : str
+        ID of the project being searched
+    path : str
+        path of folder to list subfolders of
+
+    Returns
+    -------
+    tuple
+        full paths of the subfolders
+    """
+    return tuple(
+        dx.bindings.dxfile_functions.list_subfolders(
+            project=project_id,
+            path=path,
+            recurse=False
+        )
+    )
+
+
+def load_folder_cache(cache_file):
+    """
+    Load the TSO500 folder names found for each project in previous runs
+
+    Parameters
+    ----------
+    cache_file : str
+        path to JSON file of project ID -> folder name
+
+    Returns
+    -------
+    dict
+        project ID -> folder name, empty if the file does not exist yet
+    """
+    if not os.path.exists(cache_file):
+        return {}
+
+    with open(cache_file) as fh:
+        return json.load(fh)
+
+
+def save_folder_cache(cache_file, folder_cache):
+    """
+    Save the TSO500 folder names found for each project so re-runs (e.g.
+    after waiting for files to unarchive) skip listing project folders
+
+    Parameters
+    ----------
+    cache_file : str
+        path to JSON file to write to
+    folder_cache : dict
+        project ID -> folder name
+    """
+    with open(cache_file, 'w') as fh:
+        json.dump(folder_cache, fh, indent=4, sort_keys=True)
+
+
 def get_name_of_TSO_folder(project_id):
     """
     Get the name of the main analysis folder in the TSO500 project
@@ -50,13 +125,7 @@ def get_name_of_TSO_folder(project_id):
     folder_name : str
         name of the folder within the output folder e.g. 'TSO500-230724_0472"
     """
-    folder_names = list(
-        dx.bindings.dxfile_functions.list_subfolders(
-            project=project_id,
-            path='/output/',
-            recurse=False
-        )
-    )
+    folder_names = list_subfolders(project_id, '/output/')
     #Check if there is only one run in the project and get that folder name
     folder_name = []
     #in case there is only one run get that folder name (without path)
@@ -67,13 +136,7 @@ def get_name_of_TSO_folder(project_id):
         print(f"Warning: more than one folder found for project {project_id}")
         for folder in folder_names:
             #list subfolders in each project
-            sub_folders = list(
-                dx.bindings.dxfile_functions.list_subfolders(
-                project=project_id,
-                path=folder,
-                recurse=False
-                )
-            ) 
+            sub_folders = list_subfolders(project_id, folder)
             #check for all the runs and get the one with the reports folder
             for sub_folder in sub_folders:
                 if "TSO500_reports_" in sub_folder:
@@ -132,6 +195,35 @@ def get_combinedvariantoutput_files(project_id, folder_name):
     return combined_var_files
 
 
+def get_project_files(project_id, folder_cache):
+    """
+    Find the TSO500 folder for a project and get the CombinedVariantOutput
+    files within it, wrapped together so projects can be searched
+    concurrently
+
+    Parameters
+    ----------
+    project_id : str
+        ID of the project being searched
+    folder_cache : dict
+        project ID -> folder name from previous runs (empty if not
+        caching), updated with the folder found for this project if it is
+        not already in there
+
+    Returns
+    -------
+    list
+        list of dicts containing info about the files found
+    """
+    folder_to_search = folder_cache.get(project_id)
+    if not folder_to_search:
+        folder_to_search = get_name_of_TSO_folder(project_id)
+        if folder_to_search:
+            folder_cache[project_id] = folder_to_search
+
+    return get_combinedvariantoutput_files(project_id, folder_to_search)
+
+
 def find_archived_files(combined_var_files):
     """
     Check the archivalState of all of the CombinedVariantOutput files
@@ -157,17 +249,34 @@ def find_archived_files(combined_var_files):
 
 def unarchive_files(archived_files):
     """
-    Call unarchive on any files which are not live
+    Call unarchive on any files which are not live, in one request per
+    project. If a project request fails, fall back to unarchiving each of
+    its files individually
 
     Parameters
     ----------
     archived_files : list
         list of file IDs of non-live files
     """
-    for idx, file in enumerate(archived_files):
-        print(f"Checking file {file}{idx + 1}/{len(archived_files)}")
-        file_object = dx.DXFile(file.get('id'), project=file.get('project'))
-        file_object.unarchive()
+    #group file IDs by the project they are in
+    files_per_project = defaultdict(list)
+    for file in archived_files:
+        files_per_project[file['project']].append(file['id'])
+
+    for idx, (project, file_ids) in enumerate(files_per_project.items()):
+        print(
+            f"Unarchiving {len(file_ids)} files in {project} "
+            f"{idx + 1}/{len(files_per_project)}"
+        )
+        try:
+            dx.api.project_unarchive(project, input_params={'files': file_ids})
+        except Exception as exc:
+            print(
+                f"Error unarchiving files in {project}: {exc}. Calling "
+                "unarchive on each file instead"
+            )
+            for file_id in file_ids:
+                dx.DXFile(file_id, project=project).unarchive()
 
 
 def read_to_df(file_dict):
@@ -183,37 +292,55 @@ def read_to_df(file_dict):
 
     Returns
     -------
-    msi_tmb : pd.DataFrame
-        pandas df of metrics and value for the sample
+    pd.DataFrame
+        single row pandas df of the sample with a column per metric in
+        MSI_TMB_METRIC_ROWS, named as in the file
     """
     file_id = file_dict['id']
-    
+    start_string = 'DNA Sample ID'
+    end_string = '[Gene Amplifications]'
+
+    # Stream the file line by line, keeping only the section of TSV we
+    # want and stopping once it ends so the rest is never parsed
+    section = []
+    metric = None
     with dx.open_dxfile(file_id, mode='r') as dx_file:
-        # Read TSV to pandas df
-        data = pd.read_csv(
-            dx_file, sep='\t', header=None, names=list(range(11))
+        for line in dx_file:
+            line = line.rstrip('\r\n')
+            metric = line.split('\t', 1)[0]
+            if metric == end_string:
+                break
+            if section or metric == start_string:
+                section.append(line)
+
+    if not section or metric != end_string:
+        raise ValueError(
+            f"Could not find {start_string} to {end_string} section in "
+            f"{file_dict['name']}"
         )
-        # Get indexes of section of TSV we want
-        start_string = 'DNA Sample ID'
-        idx_start = data.index[data[0] == start_string][0]
-        end_string = '[Gene Amplifications]'
-        idx_end = data.index[data[0] == end_string][0]
-
-        # Subset df to just those columns and first two columns
-        msi_tmb = data.loc[idx_start : idx_end-1][[0, 1]]
-        # Change column names to the Metric and value associated
-        msi_tmb.columns = ['Metric', 'Value']
-        #insert random column numbered
-        #to make transpose easier as columns need different names
-        #remove later
-        msi_tmb.insert(0, 'to_remove', range(1, 1 + len(msi_tmb)))
-        #create new df with transposed data
-        new = msi_tmb.set_index('to_remove').T
-
-    return new
-
-
-def concurrent_read_tsv(list_of_file_dicts, workers):
+
+    # Read just that section to a pandas df of the first two columns
+    msi_tmb = pd.read_csv(
+        io.StringIO('\n'.join(section)), sep='\t', header=None,
+        names=list(range(11))
+    )[[0, 1]]
+    # Change column names to the Metric and value associated
+    msi_tmb.columns = ['Metric', 'Value']
+    if len(msi_tmb) <= max(MSI_TMB_METRIC_ROWS):
+        raise ValueError(
+            f"Expected at least {max(MSI_TMB_METRIC_ROWS) + 1} rows from "
+            f"{start_string} to {end_string} in {file_dict['name']}, got "
+            f"{len(msi_tmb)}"
+        )
+    # Keep only the metrics we want and build a single row df of them
+    msi_tmb = msi_tmb.iloc[MSI_TMB_METRIC_ROWS]
+
+    return pd.DataFrame(
+        [msi_tmb['Value'].tolist()], columns=msi_tmb['Metric'].tolist()
+    )
+
+
+def concurrent_read_tsv(list_of_file_dicts, workers=None):
     """
     Concurrently read in the info selected to a df for each
     TSV file
@@ -223,8 +350,9 @@ def concurrent_read_tsv(list_of_file_dicts, workers):
     list_of_file_dicts : list
         list of dicts, each dict containing info on a 
         CombinedVariantOutput file
-    workers : int
-        Number of workers
+    workers : int, optional
+        Number of workers, defaults to one per file up to 64 as reading
+        is bound by network latency rather than CPU
 
     Returns
     -------
@@ -232,39 +360,101 @@ def concurrent_read_tsv(list_of_file_dicts, workers):
         single df with the gene 
         amplification data from all samples
     """
-    list_of_dfs = []
+    if not workers:
+        workers = max(1, min(64, len(list_of_file_dicts)))
+
+    dfs_by_idx = {}
     with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
         concurrent_jobs = {
             executor.submit(
                 read_to_df, file_dict
-            ): file_dict for file_dict in list_of_file_dicts
+            ): (idx, file_dict) for idx, file_dict in enumerate(
+                list_of_file_dicts
+            )
         }
         for future in concurrent.futures.as_completed(concurrent_jobs):
+            idx, file_dict = concurrent_jobs[future]
             try:
-                data = future.result()
-                list_of_dfs.append(data)
+                dfs_by_idx[idx] = (file_dict, future.result())
             except Exception as exc:
-                print(
-                    f"Error reading file for {concurrent_jobs[future]}: {exc}"
-                )
+                print(f"Error reading file for {file_dict}: {exc}")
+    #Put the dfs back in the order the files were given so the metric
+    #names used and the order of rows do not depend on which read
+    #finished first
+    list_of_dfs = [dfs_by_idx[idx] for idx in sorted(dfs_by_idx)]
+    #Metrics are picked by their row in each file, so label every df with
+    #the same metric names (from the first file) for concat to line them
+    #up by position. Warn if a file names any of them differently
+    metric_names = list(list_of_dfs[0][1].columns) if list_of_dfs else []
+    for file_dict, data in list_of_dfs:
+        if list(data.columns) != metric_names:
+            print(
+                f"Warning: metric names in {file_dict['name']} "
+                f"{list(data.columns)} differ from {metric_names}"
+            )
+        data.columns = metric_names
     #Concat all the dfs in the list to one
-    single_df = pd.concat(list_of_dfs)
+    single_df = pd.concat(
+        [data for _, data in list_of_dfs], ignore_index=True, sort=False
+    )
 
     return single_df
 
 
+def parse_args():
+    """
+    Parse command line arguments
+
+    Returns
+    -------
+    args : argparse.Namespace
+        parsed arguments
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=os.environ.get('TSO500_READ_WORKERS'),
+        help=(
+            'number of threads to read CombinedVariantOutput files with '
+            '(default: TSO500_READ_WORKERS env var, else one per file up '
+            'to 64)'
+        )
+    )
+    parser.add_argument(
+        '--folder_cache',
+        default=None,
+        help=(
+            'optional JSON file (e.g. TSO500_folder_cache.json) to cache the '
+            'TSO500 folder name of each project in between runs. Cached '
+            'folders are not re-checked, so delete the file if a project\'s '
+            '/output/ folder has changed since (default: no cache)'
+        )
+    )
+
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+
     #get tsoo500 projects
     tso_projs_ids = get_002_TSO500_projects_in_period("2023-07-15","2024-05-15")
 
-    #list of file dict
+    #list of file dict, projects searched concurrently to hide API latency
+    folder_cache = {}
+    if args.folder_cache:
+        folder_cache = load_folder_cache(args.folder_cache)
     combined_var_files = []
-    for proj in tso_projs_ids:
-        folder_to_search = get_name_of_TSO_folder(proj)
-        combined_var_files.extend(get_combinedvariantoutput_files(
-        proj, folder_to_search
-    ))
-        
+    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
+        for project_files in executor.map(
+            functools.partial(get_project_files, folder_cache=folder_cache),
+            tso_projs_ids
+        ):
+            combined_var_files.extend(project_files)
+    if args.folder_cache:
+        save_folder_cache(args.folder_cache, folder_cache)
+
     #find files that are archived
     archived_files = find_archived_files(combined_var_files)
 
@@ -281,15 +471,13 @@ def main():
         print("All files are unarchived. Reading into dataframes and concatenating")
 
     #create df with selected info from all files
-    all_samples_gene_df = concurrent_read_tsv(combined_var_files, 12)
-    #drop duplicates from transposing - keep first to act as column
-    all_samples_gene_df = all_samples_gene_df.drop_duplicates(keep='first')
-    #get rid of metrics that are not important
-    all_samples_gene_df = all_samples_gene_df.iloc[:, [0,8,20,21,22,25,26,27]] 
+    all_samples_gene_df = concurrent_read_tsv(combined_var_files, args.workers)
+    #drop any samples duplicated across projects
+    all_samples_gene_df = all_samples_gene_df.drop_duplicates()
     #drop rows that are empty
     all_samples_gene_df.dropna(inplace = True) 
     #save df into csv file
-    all_samples_gene_df.to_csv('TSO500_TMB_MSI_all.csv', index=False, header=False)
+    all_samples_gene_df.to_csv('TSO500_TMB_MSI_all.csv', index=False)
 
         #Get final matches between helpdesk samples and all obtained
     #get samples from helpdesk and name column
@@ -303,29 +491,16 @@ def main():
     #convert sample name
     all_samples['sample_name'] = all_samples["DNA Sample ID"].str.split('-').str[1]
 
-    #Initialize an empty list to store matching sample names
-    matching_samples = []
-
-    #Iterate over each sample_name in all_samples
-    for i in all_samples['sample_name']:
-        #Iterate over each sample in helpdesk_table
-        for l in helpdesk_table['sample']:
-            #Convert l and i to strings before stripping
-            l_str = str(l)
-            i_str = str(i)
-            #Check if the stripped versions of l and i are equal
-            if l_str.strip() == i_str.strip():
-                #If a match is found, append the sample name 
-                # to the list and break the loop
-                matching_samples.append(i)
-                print('true')
-                break  
-        else:
-        
-            print('')  
+    #Strip both sets of names and match with a single set lookup
+    helpdesk_samples = set(
+        helpdesk_table['sample'].dropna().astype(str).str.strip()
+    )
+    matches = all_samples['sample_name'].astype(str).str.strip().isin(
+        helpdesk_samples
+    )
 
     #Filter all_samples based on matching sample names
-    results = all_samples[all_samples["sample_name"].isin(matching_samples)]
+    results = all_samples[matches]
     #save matches and all to csv
     results.iloc[:,1:].to_csv('TSO500_TMB_MSI_matches.csv', index=False)
     all_samples.iloc[:,1:].to_csv('TSO500_TMB_MSI_final.csv', index=False)
@@ -9,27 +9,88 @@ around times, tumour QC metrics etc.)
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from functools import reduce
+from io import StringIO
 from pathlib import Path
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import pandas as pd
+from lxml import html as lxml_html
 
 
-def extract_tables(file: Path) -> List[pd.DataFrame]:
+def has_readable_table(table: lxml_html.HtmlElement) -> bool:
     """
+    Check if pandas would find any table to read in a table element, i.e.
+    the table or one nested in it is not hidden and has non-whitespace
+    text. Tables failing this give no DataFrames from pd.read_html.
+
+    Parameters
+    ----------
+    table : lxml.html.HtmlElement
+        Table element to check
+
+    Returns
+    -------
+    bool
+        True if there is a table pandas would read
+    """
+    for element in [table] + table.xpath(".//table"):
+        if "display:none" in element.get("style", "").replace(" ", ""):
+            continue
+
+        if any(text.strip() for text in element.xpath(".//text()")):
+            return True
+
+    return False
+
+
+def extract_tables(file: Path, n_tables: int = 5) -> List[pd.DataFrame]:
+    """
+    Read the first n tables from the HTML file, as pd.read_html would
+    return them for the whole file.
+
+    The document is parsed once with lxml and each top level table (with
+    any tables nested inside it) is passed to pandas in turn, so pandas
+    still applies its own filtering of empty and hidden tables. Reading
+    stops once enough tables are found, so no DataFrames are built for
+    the rest of the tables in the file.
+
     Parameters
     ----------
     file : pathlib.Path
         Path to file to read from
+    n_tables : int
+        Number of tables to read from the start of the file
 
     Returns
     -------
     List[pd.DataFrame]
         List of dataframes read from file
     """
-    return pd.read_html(file)
+    tables = []
+
+    for table in lxml_html.parse(str(file)).xpath(
+        "//table[not(ancestor::table)]"
+    ):
+        if not has_readable_table(table):
+            continue
+
+        tables.extend(
+            pd.read_html(
+                StringIO(lxml_html.tostring(table, encoding="unicode")),
+                flavor="lxml",
+            )
+        )
+
+        if len(tables) >= n_tables:
+            break
+
+    if not tables:
+        raise ValueError("No tables found")
+
+    return tables[:n_tables]
 
 
 def select_tables(
@@ -89,6 +150,62 @@ def select_tables(
     return sample_tables, qual_table
 
 
+def process_file(
+    file: Tuple[str, Path],
+) -> Tuple[Optional[pd.DataFrame], Optional[pd.DataFrame], Optional[str]]:
+    """
+    Extract and select the tables from a single HTML file, run in a
+    separate process from main() so files can be parsed in parallel.
+
+    Parameters
+    ----------
+    file : tuple
+        Tuple of file name and the parent directory it is in
+
+    Returns
+    -------
+    pd.DataFrame | None
+        Single row DataFrame of sample details, None if file errored
+    pd.DataFrame | None
+        Two row DataFrame of germline / tumour quality, None if file errored
+    str | None
+        Error message if the file failed to be processed
+    """
+    try:
+        tables = extract_tables(file[1] / Path(file[0]))
+        sample_tables_df, qual_table_df = select_tables(tables)
+    except Exception as exc:
+        return None, None, str(exc)
+
+    return sample_tables_df, qual_table_df, None
+
+
+def concat_tables(tables: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate tables from all files into one, aligning all to the union
+    of their columns first so pandas does not re-align each one in turn.
+
+    Parameters
+    ----------
+    tables : list
+        List of dataframes to concatenate
+
+    Returns
+    -------
+    pd.DataFrame
+        Single DataFrame of all rows, columns in the order first seen
+    """
+    columns = list(
+        dict.fromkeys(column for table in tables for column in table.columns)
+    )
+
+    return pd.concat(
+        [table.reindex(columns=columns) for table in tables],
+        ignore_index=True,
+        sort=False,
+    )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -97,6 +214,15 @@ def main():
         required=True,
         nargs="+",
     )
+    parser.add_argument(
+        "--workers",
+        help=(
+            "number of processes to parse HTML files with (default: CPU"
+            " count)"
+        ),
+        type=int,
+        default=None,
+    )
     args = parser.parse_args()
 
     all_file_paths = {}
@@ -108,41 +234,49 @@ def main():
                 f"Path does not exist or is not a directory: {path}"
             )
 
-        files = list(Path(path).rglob("*.supplementary.html"))
-        print(f"Found {len(files)} in {path}")
+        found = 0
+
+        for html in Path(path).rglob("*.supplementary.html"):
+            found += 1
+            parent = html.resolve().parent
 
-        for html in files:
             if html.name in all_file_paths:
                 print(
                     f"Warning: {html.name} already found at"
                     f" {all_file_paths[html.name]}, skipping..."
                 )
-                duplicate_files[html.name] = html.resolve().parent
+                duplicate_files[html.name] = parent
             else:
-                all_file_paths[html.name] = html.resolve().parent
+                all_file_paths[html.name] = parent
+
+        print(f"Found {found} in {path}")
 
     sample_detail_dfs = []
     germline_tumour_quality_dfs = []
     error_files = []
 
-    for idx, file in enumerate(all_file_paths.items(), 1):
-        print(f"[{idx}/{len(all_file_paths)}] {file[0]}")
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        results = executor.map(
+            process_file, all_file_paths.items(), chunksize=8
+        )
+
+        for idx, (file, result) in enumerate(
+            zip(all_file_paths.items(), results), 1
+        ):
+            print(f"[{idx}/{len(all_file_paths)}] {file[0]}")
+            sample_tables_df, qual_table_df, error = result
 
-        try:
-            tables = extract_tables(file[1] / Path(file[0]))
-            sample_tables_df, qual_table_df = select_tables(tables)
+            if error:
+                print(f"Error processing {file}: {error}")
+                error_files.append(file)
+                continue
 
             sample_detail_dfs.append(sample_tables_df)
             germline_tumour_quality_dfs.append(qual_table_df)
-        except Exception as exc:
-            print(f"Error processing {file}: {exc}")
-            error_files.append(file)
 
-    all_sample_details_df = pd.concat(
-        sample_detail_dfs, ignore_index=True, sort=False
-    )
-    all_germline_tumour_quality_dfs = pd.concat(
-        germline_tumour_quality_dfs, ignore_index=True, sort=False
+    all_sample_details_df = concat_tables(sample_detail_dfs)
+    all_germline_tumour_quality_dfs = concat_tables(
+        germline_tumour_quality_dfs
     )
 
     print(all_sample_details_df)